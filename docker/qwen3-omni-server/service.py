@@ -5,14 +5,34 @@ Provides OpenAI-compatible API with async model loading
 """
 
 import os
+import asyncio
 import json
 import base64
+import ctypes
+import functools
+import importlib.util
 import io
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, List, Union
 from contextlib import asynccontextmanager
 
+# Must be set before torch initializes CUDA: expandable segments avoid the
+# "reserved >> allocated" fragmentation the MoE experts cause on long contexts.
+# QWEN_USE_MEMPOOL_THRESHOLD=1 switches to the stream-ordered cudaMallocAsync
+# backend instead; PyTorch sets its pool's release threshold to UINT64_MAX, so
+# freed KV buffers stay in the driver pool between requests.
+USE_MEMPOOL_THRESHOLD = os.environ.get("QWEN_USE_MEMPOOL_THRESHOLD", "0") == "1"
+if USE_MEMPOOL_THRESHOLD:
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "backend:cudaMallocAsync")
+else:
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512")
+
+# Multi-connection downloads when MODEL_PATH is a hub id rather than a local dir
+if importlib.util.find_spec("hf_transfer") is not None:
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+
 import torch
 import numpy as np
 from PIL import Image
@@ -25,6 +45,26 @@ MODEL_PATH = os.environ.get("MODEL_PATH", "/models")
 DEVICE = os.environ.get("DEVICE", "cuda" if torch.cuda.is_available() else "cpu")
 MAX_MODEL_LEN = int(os.environ.get("MAX_MODEL_LEN", "4096"))
 PORT = int(os.environ.get("PORT", "8000"))
+TORCH_COMPILE = os.environ.get("TORCH_COMPILE", "1") == "1"
+TORCH_COMPILE_MODE = os.environ.get("TORCH_COMPILE_MODE", "reduce-overhead")
+WARMUP_TOKENS = int(os.environ.get("WARMUP_TOKENS", "8"))
+STATIC_KV_CACHE = os.environ.get("STATIC_KV_CACHE", "1") == "1"
+GPU_MEMORY_FRACTION = float(os.environ.get("GPU_MEMORY_FRACTION", "0.9"))
+GPU_WEIGHTS_FRACTION = float(os.environ.get("GPU_WEIGHTS_FRACTION", "0.85"))
+CPU_MAX_MEMORY = os.environ.get("CPU_MAX_MEMORY", "24GiB")
+OFFLOAD_FOLDER = os.environ.get("OFFLOAD_FOLDER", "/tmp/qwen3-omni-offload")
+QUANT_MODE = os.environ.get("QUANT_MODE", "none").lower()  # none, int8, nf4
+ATTN_IMPLEMENTATION = os.environ.get("ATTN_IMPLEMENTATION", "")  # empty = auto
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "4"))
+DEFAULT_MAX_TOKENS = int(os.environ.get("DEFAULT_MAX_TOKENS", "512"))
+DEFAULT_TEMPERATURE = 0.7
+PROMPT_CACHE_MAX_CHARS = int(os.environ.get("PROMPT_CACHE_MAX_CHARS", "4096"))
+BATCH_WINDOW_MS = float(os.environ.get("BATCH_WINDOW_MS", "10"))
+SEQ_BUCKETS = [int(x) for x in os.environ.get("SEQ_BUCKETS", "128,512,1024").split(",") if x]
+BATCH_BUCKETS = [bs for bs in (1, 2, 4) if bs <= MAX_BATCH_SIZE]
+
+# Encoders and output heads stay in bf16 to preserve audio/vision fidelity
+QUANT_SKIP_MODULES = ["audio_tower", "visual", "code2wav", "lm_head"]
 
 # Global model and processor
 model = None
@@ -33,6 +73,29 @@ model_loading = False
 model_loaded = False
 loading_error = None
 
+# Static KV cache shared by all requests; generate() calls are serialized by the lock
+kv_cache = None
+generate_lock = threading.Lock()
+
+# Set once torch.compile succeeded; shapes are then bucketed to reuse CUDA graphs
+model_compiled = False
+# Seconds spent warming each (batch_size, seq_len) bucket
+warmed_buckets = {}
+# Held for the duration of a bucket warm-up; only one may run at a time
+warmup_lock = threading.Lock()
+model_warming = False
+
+# Whether the default CUDA memory pool currently retains freed memory
+mempool_threshold_active = False
+
+CUDA_MEMPOOL_ATTR_RELEASE_THRESHOLD = 4  # cudaMemPoolAttrReleaseThreshold
+
+# Pending generation jobs, drained by batch_worker()
+request_queue = None
+
+# Chat templating and tokenization run here so they never block the event loop
+tokenize_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="tokenize")
+
 
 class ChatMessage(BaseModel):
     role: str
@@ -53,6 +116,20 @@ class TextRequest(BaseModel):
     temperature: Optional[float] = 0.7
 
 
+class GenerationJob:
+    """A tokenized prompt waiting in the request queue for a batched generate()"""
+    
+    def __init__(self, input_ids: List[int], max_tokens: int, temperature: float, future: asyncio.Future):
+        self.input_ids = input_ids
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.future = future
+
+
+class WarmupInProgress(RuntimeError):
+    """Raised when a bucket warm-up is requested while another is running"""
+
+
 class HealthResponse(BaseModel):
     status: str
     model: str
@@ -61,9 +138,270 @@ class HealthResponse(BaseModel):
     loading: bool
 
 
+def compile_model():
+    """Compile the text decoder with torch.compile and warm it up.
+
+    Only the thinker's language model is compiled: the audio/vision towers run
+    once per request and would just add graph breaks. Falls back to eager mode
+    if compilation fails.
+    """
+    global model_compiled
+    
+    thinker = getattr(model, "thinker", None)
+    target = getattr(thinker, "model", None) or model
+
+    print(f"[Background] Compiling {type(target).__name__} (mode={TORCH_COMPILE_MODE})...")
+    eager_forward = target.forward
+    try:
+        with torch.inference_mode():
+            target.forward = torch.compile(eager_forward, mode=TORCH_COMPILE_MODE, fullgraph=False)
+        warmup_model()
+        model_compiled = True
+        print("[Background] ✓ Model compiled")
+    except Exception as e:
+        target.forward = eager_forward
+        print(f"[Background] ⚠ torch.compile failed, falling back to eager mode: {e}")
+
+
+def set_mempool_release_threshold(threshold: int) -> bool:
+    """Set the release threshold of the current device's default CUDA memory pool.
+    
+    Only used by the check_mempool_growth() fallback; PyTorch exposes no API
+    for pool attributes.
+    """
+    cudart = None
+    for name in ("libcudart.so", "libcudart.so.13", "libcudart.so.12"):
+        try:
+            cudart = ctypes.CDLL(name)
+            break
+        except OSError:
+            continue
+    if cudart is None:
+        print("[Background] ⚠ libcudart not found, cannot tune memory pool")
+        return False
+    
+    pool = ctypes.c_void_p()
+    if cudart.cudaDeviceGetDefaultMemPool(ctypes.byref(pool), torch.cuda.current_device()) != 0:
+        return False
+    
+    value = ctypes.c_uint64(threshold)
+    return cudart.cudaMemPoolSetAttribute(
+        pool, CUDA_MEMPOOL_ATTR_RELEASE_THRESHOLD, ctypes.byref(value)
+    ) == 0
+
+
+def check_mempool_growth():
+    """Stop retaining pool memory once reserved memory outgrows the GPU budget.
+    
+    cudaMallocAsync can fragment under MoE routing; the backend cannot be
+    swapped at runtime, so fall back to releasing memory eagerly.
+    """
+    global mempool_threshold_active
+    
+    if not mempool_threshold_active:
+        return
+    
+    budget = torch.cuda.get_device_properties(0).total_memory * GPU_MEMORY_FRACTION
+    if torch.cuda.memory_reserved() <= budget:
+        return
+    
+    set_mempool_release_threshold(0)
+    torch.cuda.empty_cache()
+    mempool_threshold_active = False
+    print("⚠ CUDA memory pool outgrew its budget; release threshold reset to 0. "
+          "Unset QWEN_USE_MEMPOOL_THRESHOLD to use expandable_segments instead.")
+
+
+def select_attn_implementation() -> str:
+    """Use FlashAttention-2 when flash-attn is installed on a CUDA host, otherwise SDPA"""
+    if ATTN_IMPLEMENTATION:
+        return ATTN_IMPLEMENTATION
+    if not torch.cuda.is_available():
+        return "sdpa"
+    
+    try:
+        import flash_attn  # noqa: F401
+        return "flash_attention_2"
+    except ImportError:
+        return "sdpa"
+
+
+def build_quantization_config():
+    """Build the bitsandbytes config for QUANT_MODE, or None to load bf16 weights.
+    
+    Falls back to bf16 with a warning if bitsandbytes is unusable.
+    """
+    if QUANT_MODE == "none":
+        return None
+    
+    try:
+        import bitsandbytes  # noqa: F401
+        from transformers import BitsAndBytesConfig
+        
+        if QUANT_MODE == "nf4":
+            return BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_compute_dtype=torch.bfloat16,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_use_double_quant=True,
+                llm_int8_skip_modules=QUANT_SKIP_MODULES,
+            )
+        if QUANT_MODE == "int8":
+            return BitsAndBytesConfig(
+                load_in_8bit=True,
+                llm_int8_threshold=0.0,
+                llm_int8_skip_modules=QUANT_SKIP_MODULES,
+            )
+        raise ValueError(f"Unknown QUANT_MODE '{QUANT_MODE}' (expected none, int8 or nf4)")
+    except Exception as e:
+        print(f"[Background] ⚠ Quantization disabled, loading bf16 weights: {e}")
+        return None
+
+
+def build_max_memory():
+    """Memory budget per device for device_map="auto", leaving GPU headroom for activations"""
+    if not torch.cuda.is_available():
+        return None
+    
+    max_memory = {}
+    for i in range(torch.cuda.device_count()):
+        gpu_bytes = torch.cuda.get_device_properties(i).total_memory * GPU_WEIGHTS_FRACTION
+        max_memory[i] = f"{int(gpu_bytes / 2**30)}GiB"
+    max_memory["cpu"] = CPU_MAX_MEMORY
+    return max_memory
+
+
+def build_kv_cache():
+    """Pre-allocate a static KV cache for the thinker sized to MAX_MODEL_LEN"""
+    from transformers import StaticCache
+    
+    thinker = getattr(model, "thinker", model)
+    config = getattr(thinker.config, "text_config", thinker.config)
+    
+    return StaticCache(
+        config=config,
+        max_batch_size=1,
+        max_cache_len=MAX_MODEL_LEN,
+        device=model.device,
+        dtype=torch.bfloat16,
+    )
+
+
+def generate_text(inputs, max_new_tokens: int, temperature: float = 0.0):
+    """Run model.generate() for text only, reusing the static KV cache when the request fits.
+    
+    Audio output is disabled: the talker would synthesize speech nobody reads,
+    and Qwen3-Omni rejects batched inputs while it is enabled. Returns the
+    thinker's token ids.
+    
+    Generation runs under torch.inference_mode(), so the returned tensors are
+    inference tensors: they can be read and sliced but not modified in-place
+    outside of inference mode.
+    """
+    prompt_len = inputs.input_ids.shape[1]
+    use_cache = (
+        kv_cache is not None
+        and inputs.input_ids.shape[0] == 1
+        and prompt_len + max_new_tokens <= MAX_MODEL_LEN
+    )
+    
+    # Qwen3-Omni's generate() only forwards "thinker_"-prefixed kwargs to the
+    # text model; unprefixed ones fall back to the thinker's own defaults
+    gen_kwargs = dict(
+        thinker_max_new_tokens=max_new_tokens,
+        thinker_temperature=temperature,
+        thinker_do_sample=temperature > 0,
+    )
+    
+    with generate_lock, torch.inference_mode():
+        if use_cache:
+            kv_cache.reset()
+            text_ids, _ = model.generate(
+                **inputs, **gen_kwargs, return_audio=False, thinker_past_key_values=kv_cache
+            )
+        else:
+            text_ids, _ = model.generate(**inputs, **gen_kwargs, return_audio=False)
+    
+    check_mempool_growth()
+    return text_ids
+
+
+def warmup_model(max_new_tokens: int = WARMUP_TOKENS):
+    """Run a short text-only generate() so compilation happens before the first real request.
+    
+    Goes through generate_text(), so max_new_tokens reaches the thinker and
+    no speech is synthesized.
+    """
+    conversation = [{"role": "user", "content": "Hello"}]
+    text = processor.apply_chat_template(
+        conversation,
+        tokenize=False,
+        add_generation_prompt=True
+    )
+    inputs = processor(text=[text], return_tensors="pt").to(model.device)
+
+    start = time.time()
+    generate_text(inputs, max_new_tokens=max_new_tokens)
+    print(f"[Background] ✓ Warm-up generate finished in {time.time() - start:.1f}s")
+
+
+def smallest_bucket(value: int, buckets: List[int]) -> Optional[int]:
+    """Smallest bucket that fits value, or None if it exceeds them all"""
+    for bucket in sorted(buckets):
+        if value <= bucket:
+            return bucket
+    return None
+
+
+def warmup_buckets() -> dict:
+    """Run generate() for every (batch size, sequence bucket) so torch.compile
+    captures their CUDA graphs before real traffic arrives.
+    
+    Each bucket generates WARMUP_TOKENS text-only tokens through
+    generate_text(). Buckets that do not fit MAX_MODEL_LEN are skipped, and a
+    failing bucket is logged and skipped rather than aborting the rest.
+    Returns {"warmed": {(bs, seq): seconds}, "failed": {(bs, seq): error}}.
+    
+    Raises WarmupInProgress if another warm-up is already running.
+    """
+    global model_warming
+    from transformers import BatchEncoding
+    
+    if not warmup_lock.acquire(blocking=False):
+        raise WarmupInProgress("Warm-up already in progress")
+    
+    model_warming = True
+    try:
+        pad_token_id = processor.tokenizer.pad_token_id or 0
+        failed = {}
+        for bs in BATCH_BUCKETS:
+            for seq in sorted(SEQ_BUCKETS):
+                if seq + WARMUP_TOKENS > MAX_MODEL_LEN:
+                    continue
+                inputs = BatchEncoding({
+                    "input_ids": torch.full((bs, seq), pad_token_id, dtype=torch.long, device=model.device),
+                    "attention_mask": torch.ones((bs, seq), dtype=torch.long, device=model.device),
+                })
+                start = time.time()
+                try:
+                    generate_text(inputs, max_new_tokens=WARMUP_TOKENS)
+                except Exception as e:
+                    warmed_buckets.pop((bs, seq), None)
+                    failed[(bs, seq)] = str(e)
+                    print(f"[Warmup] ⚠ batch={bs} seq={seq} failed: {e}")
+                    continue
+                warmed_buckets[(bs, seq)] = round(time.time() - start, 2)
+                print(f"[Warmup] ✓ batch={bs} seq={seq} in {warmed_buckets[(bs, seq)]}s")
+        return {"warmed": dict(warmed_buckets), "failed": failed}
+    finally:
+        model_warming = False
+        warmup_lock.release()
+
+
 def load_model_async():
     """Load Qwen3-Omni model and processor in background thread"""
-    global model, processor, model_loading, model_loaded, loading_error
+    global model, processor, model_loading, model_loaded, loading_error, kv_cache
+    global mempool_threshold_active
     
     if model_loading or model_loaded:
         return
@@ -77,6 +415,12 @@ def load_model_async():
     if torch.cuda.is_available():
         print(f"[Background] CUDA device: {torch.cuda.get_device_name(0)}")
         print(f"[Background] CUDA memory: {torch.cuda.get_device_properties(0).total_memory / 1e9:.2f} GB")
+        print(f"[Background] CUDA allocator: {torch.cuda.get_allocator_backend()}")
+        
+        # The cudaMallocAsync backend already retains freed memory in its pool
+        if USE_MEMPOOL_THRESHOLD and torch.cuda.get_allocator_backend() == "cudaMallocAsync":
+            mempool_threshold_active = True
+            print("[Background] ✓ CUDA memory pool retains freed memory across requests")
     
     try:
         from transformers import Qwen3OmniMoeForConditionalGeneration, AutoProcessor
@@ -84,20 +428,45 @@ def load_model_async():
         # Load processor
         print("[Background] Loading processor...")
         processor = AutoProcessor.from_pretrained(MODEL_PATH, trust_remote_code=True)
+        # Batched prompts are left-padded so generation continues from the last token
+        processor.tokenizer.padding_side = "left"
         print("[Background] ✓ Processor loaded")
         
         # Load model with optimizations for Jetson
         print("[Background] Loading model (this may take 10-20 minutes)...")
         print("[Background] Loading 70GB model, please wait...")
+        print(f"[Background] Quantization: {QUANT_MODE}")
+        attn_implementation = select_attn_implementation()
+        print(f"[Background] Attention: {attn_implementation}")
+        max_memory = build_max_memory()
+        print(f"[Background] Memory budget: {max_memory}, offload folder: {OFFLOAD_FOLDER}")
         
-        # Use device_map="auto" for efficient memory allocation
-        model = Qwen3OmniMoeForConditionalGeneration.from_pretrained(
-            MODEL_PATH,
+        # Use device_map="auto" with explicit budgets so accelerate does not
+        # overcommit unified memory; whatever does not fit spills to disk
+        load_kwargs = dict(
             torch_dtype=torch.bfloat16,
             device_map="auto",
+            max_memory=max_memory,
+            offload_folder=OFFLOAD_FOLDER,
             trust_remote_code=True,
             low_cpu_mem_usage=True,
+            attn_implementation=attn_implementation,
         )
+        quantization_config = build_quantization_config()
+        try:
+            model = Qwen3OmniMoeForConditionalGeneration.from_pretrained(
+                MODEL_PATH,
+                quantization_config=quantization_config,
+                **load_kwargs,
+            )
+        except Exception as e:
+            if quantization_config is None:
+                raise
+            print(f"[Background] ⚠ Quantized load failed, retrying with bf16 weights: {e}")
+            model = None
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            model = Qwen3OmniMoeForConditionalGeneration.from_pretrained(MODEL_PATH, **load_kwargs)
         
         print(f"[Background] ✓ Model loaded on {model.device}")
         
@@ -105,6 +474,31 @@ def load_model_async():
         total_params = sum(p.numel() for p in model.parameters())
         print(f"[Background] Total parameters: {total_params / 1e9:.2f}B")
         
+        if torch.cuda.is_available():
+            torch.cuda.set_per_process_memory_fraction(GPU_MEMORY_FRACTION)
+        
+        if STATIC_KV_CACHE:
+            try:
+                kv_cache = build_kv_cache()
+                # With torch.compile on, compile_model()'s warm-up exercises the cache
+                if not TORCH_COMPILE:
+                    warmup_model()
+                print(f"[Background] ✓ Static KV cache allocated (max_cache_len={MAX_MODEL_LEN})")
+            except Exception as e:
+                kv_cache = None
+                print(f"[Background] ⚠ Static KV cache unavailable, using dynamic cache: {e}")
+        
+        if TORCH_COMPILE:
+            compile_model()
+        
+        # Capture graphs before reporting healthy so the first requests
+        # don't queue behind the warm-up
+        if model_compiled:
+            try:
+                warmup_buckets()
+            except Exception as e:
+                print(f"[Background] ⚠ Bucket warm-up failed: {e}")
+        
         model_loaded = True
         loading_error = None
         
@@ -117,10 +511,138 @@ def load_model_async():
         model_loading = False
 
 
+def render_prompt(conversation: List[dict]) -> str:
+    """Apply the chat template to a conversation"""
+    return processor.apply_chat_template(
+        conversation,
+        tokenize=False,
+        add_generation_prompt=True
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def render_prompt_cached(conversation_json: str) -> str:
+    """render_prompt() for small text-only conversations, keyed by their JSON"""
+    return render_prompt(json.loads(conversation_json))
+
+
+def preprocess(conversation: List[dict]) -> List[int]:
+    """Render and tokenize a conversation; runs in tokenize_pool.
+    
+    Only small text-only conversations go through the cache: multimodal
+    content can carry inline base64 media that would bloat the cache keys.
+    """
+    cacheable = all(isinstance(msg["content"], str) for msg in conversation) and (
+        sum(len(msg["content"]) for msg in conversation) <= PROMPT_CACHE_MAX_CHARS
+    )
+    if cacheable:
+        text = render_prompt_cached(json.dumps(conversation, sort_keys=True))
+    else:
+        text = render_prompt(conversation)
+    return processor(text=[text])["input_ids"][0]
+
+
+def generate_batch(jobs: List[GenerationJob]) -> List[dict]:
+    """Run one generate() over a batch of prompts sharing the same temperature"""
+    input_ids = [job.input_ids for job in jobs]
+    bucket = None
+    if model_compiled:
+        # Pad up to a warmed (batch size, sequence) bucket so the captured
+        # CUDA graphs are reused instead of recompiling for every shape.
+        # Filler rows repeat the first prompt; their outputs are discarded.
+        batch_size = smallest_bucket(len(jobs), BATCH_BUCKETS) or len(jobs)
+        input_ids += [jobs[0].input_ids] * (batch_size - len(jobs))
+        bucket = smallest_bucket(max(len(ids) for ids in input_ids), SEQ_BUCKETS)
+    
+    inputs = processor.tokenizer.pad(
+        {"input_ids": input_ids},
+        padding="max_length" if bucket else True,
+        max_length=bucket,
+        return_tensors="pt"
+    )
+    # Stage through pinned memory so the H2D copy does not block the host thread
+    pin = model.device.type == "cuda"
+    for key, value in inputs.items():
+        if pin:
+            value = value.pin_memory()
+        inputs[key] = value.to(model.device, non_blocking=pin)
+    
+    outputs = generate_text(
+        inputs,
+        max_new_tokens=max(job.max_tokens for job in jobs),
+        temperature=jobs[0].temperature,
+    )
+    
+    prompt_len = inputs.input_ids.shape[1]
+    pad_token_id = processor.tokenizer.pad_token_id
+    results = []
+    for i, job in enumerate(jobs):
+        tokens = outputs[i, prompt_len:prompt_len + job.max_tokens]
+        if pad_token_id is not None:
+            tokens = tokens[tokens != pad_token_id]
+        results.append({
+            "text": processor.decode(tokens, skip_special_tokens=True),
+            "prompt_tokens": int(inputs.attention_mask[i].sum()),
+            "completion_tokens": len(tokens),
+        })
+    return results
+
+
+async def batch_worker():
+    """Coalesce queued jobs arriving within BATCH_WINDOW_MS into batched generate() calls"""
+    loop = asyncio.get_running_loop()
+    
+    while True:
+        batch = [await request_queue.get()]
+        deadline = loop.time() + BATCH_WINDOW_MS / 1000
+        while len(batch) < MAX_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(request_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        
+        # Jobs with different sampling settings cannot share a generate() call
+        groups = {}
+        for job in batch:
+            groups.setdefault(job.temperature, []).append(job)
+        
+        for jobs in groups.values():
+            try:
+                results = await loop.run_in_executor(None, generate_batch, jobs)
+            except Exception as e:
+                for job in jobs:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                continue
+            for job, result in zip(jobs, results):
+                if not job.future.done():
+                    job.future.set_result(result)
+
+
+async def submit_generation(conversation: List[dict], max_tokens: Optional[int],
+                            temperature: Optional[float]) -> dict:
+    """Tokenize a conversation off the event loop, queue it for batched generation and wait"""
+    # Explicit nulls in the request fall back to defaults so they never reach a batch
+    if max_tokens is None:
+        max_tokens = DEFAULT_MAX_TOKENS
+    if temperature is None:
+        temperature = DEFAULT_TEMPERATURE
+    
+    loop = asyncio.get_running_loop()
+    input_ids = await loop.run_in_executor(tokenize_pool, preprocess, conversation)
+    
+    future = loop.create_future()
+    await request_queue.put(GenerationJob(input_ids, max_tokens, temperature, future))
+    return await future
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifespan context manager for startup/shutdown"""
-    global model_loading
+    global model_loading, request_queue
     
     print("Starting Qwen3-Omni Service...")
     print("⚡ Async loading mode: Model will load in background")
@@ -129,10 +651,16 @@ async def lifespan(app: FastAPI):
     loading_thread = threading.Thread(target=load_model_async, daemon=True)
     loading_thread.start()
     
+    # Start the batching worker
+    request_queue = asyncio.Queue()
+    worker = asyncio.create_task(batch_worker())
+    
     yield
     
     # Shutdown
     print("Shutting down Qwen3-Omni Service...")
+    worker.cancel()
+    tokenize_pool.shutdown(wait=False)
 
 
 app = FastAPI(
@@ -147,7 +675,12 @@ app = FastAPI(
 async def health():
     """Health check endpoint - returns loading status"""
     return HealthResponse(
-        status="loading" if model_loading else ("healthy" if model_loaded else "unhealthy"),
+        status=(
+            "warming" if model_warming
+            else "loading" if model_loading
+            else "healthy" if model_loaded
+            else "unhealthy"
+        ),
         model="Qwen3-Omni-30B-A3B",
         device=str(model.device) if model else DEVICE,
         loaded=model_loaded,
@@ -189,34 +722,8 @@ async def chat_completion(request: ChatRequest):
             else:
                 conversation.append({"role": msg.role, "content": msg.content})
         
-        # Apply chat template
-        text = processor.apply_chat_template(
-            conversation,
-            tokenize=False,
-            add_generation_prompt=True
-        )
-        
-        # Process inputs
-        inputs = processor(
-            text=[text],
-            return_tensors="pt",
-            padding=True
-        ).to(model.device)
-        
-        # Generate
-        with torch.no_grad():
-            outputs = model.generate(
-                **inputs,
-                max_new_tokens=request.max_tokens,
-                temperature=request.temperature,
-                do_sample=request.temperature > 0,
-            )
-        
-        # Decode response
-        response_text = processor.batch_decode(
-            outputs[:, inputs.input_ids.shape[1]:],
-            skip_special_tokens=True
-        )[0]
+        # Generate (batched with other pending requests)
+        result = await submit_generation(conversation, request.max_tokens, request.temperature)
         
         return {
             "id": "chatcmpl-qwen3omni",
@@ -228,15 +735,15 @@ async def chat_completion(request: ChatRequest):
                     "index": 0,
                     "message": {
                         "role": "assistant",
-                        "content": response_text
+                        "content": result["text"]
                     },
                     "finish_reason": "stop"
                 }
             ],
             "usage": {
-                "prompt_tokens": inputs.input_ids.shape[1],
-                "completion_tokens": len(outputs[0]) - inputs.input_ids.shape[1],
-                "total_tokens": len(outputs[0])
+                "prompt_tokens": result["prompt_tokens"],
+                "completion_tokens": result["completion_tokens"],
+                "total_tokens": result["prompt_tokens"] + result["completion_tokens"]
             }
         }
         
@@ -262,35 +769,13 @@ async def text_inference(request: TextRequest):
             {"role": "user", "content": request.text}
         ]
         
-        # Apply chat template
-        text = processor.apply_chat_template(
-            conversation,
-            tokenize=False,
-            add_generation_prompt=True
-        )
-        
-        # Process
-        inputs = processor(text=[text], return_tensors="pt").to(model.device)
-        
-        # Generate
-        with torch.no_grad():
-            outputs = model.generate(
-                **inputs,
-                max_new_tokens=request.max_tokens,
-                temperature=request.temperature,
-                do_sample=request.temperature > 0,
-            )
-        
-        # Decode
-        response = processor.batch_decode(
-            outputs[:, inputs.input_ids.shape[1]:],
-            skip_special_tokens=True
-        )[0]
+        # Generate (batched with other pending requests)
+        result = await submit_generation(conversation, request.max_tokens, request.temperature)
         
         return {
-            "text": response,
-            "input_tokens": inputs.input_ids.shape[1],
-            "output_tokens": len(outputs[0]) - inputs.input_ids.shape[1]
+            "text": result["text"],
+            "input_tokens": result["prompt_tokens"],
+            "output_tokens": result["completion_tokens"]
         }
         
     except Exception as e:
@@ -300,6 +785,51 @@ async def text_inference(request: TextRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/warmup")
+async def warmup():
+    """Capture CUDA graphs for all batch size / sequence length buckets"""
+    if not model_loaded:
+        raise HTTPException(status_code=503, detail="Model is not loaded")
+    if not model_compiled:
+        raise HTTPException(status_code=409, detail="Model is not compiled, nothing to warm up")
+    if warmup_lock.locked():
+        raise HTTPException(status_code=409, detail="Warm-up already in progress")
+    
+    loop = asyncio.get_running_loop()
+    try:
+        result = await loop.run_in_executor(None, warmup_buckets)
+    except WarmupInProgress as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    
+    return {
+        "buckets": [
+            {"batch_size": bs, "seq_len": seq, "seconds": seconds}
+            for (bs, seq), seconds in sorted(result["warmed"].items())
+        ],
+        "failed": [
+            {"batch_size": bs, "seq_len": seq, "error": error}
+            for (bs, seq), error in sorted(result["failed"].items())
+        ]
+    }
+
+
+@app.post("/admin/defrag")
+async def defrag():
+    """Release cached CUDA blocks back to the driver (call between idle periods)"""
+    if not torch.cuda.is_available():
+        return {"freed_bytes": 0, "reserved_bytes": 0, "allocated_bytes": 0}
+    
+    reserved_before = torch.cuda.memory_reserved()
+    torch.cuda.empty_cache()
+    reserved_after = torch.cuda.memory_reserved()
+    
+    return {
+        "freed_bytes": reserved_before - reserved_after,
+        "reserved_bytes": reserved_after,
+        "allocated_bytes": torch.cuda.memory_allocated(),
+    }
+
+
 @app.get("/status")
 async def status():
     """Get detailed loading status"""
@@ -307,6 +837,7 @@ async def status():
         "model": "Qwen3-Omni-30B-A3B",
         "loaded": model_loaded,
         "loading": model_loading,
+        "warming": model_warming,
         "error": loading_error,
         "device": str(model.device) if model else DEVICE,
     }
@@ -314,4 +845,8 @@ async def status():
 
 if __name__ == "__main__":
     import uvicorn
+    # Single process on purpose: CUDA contexts do not survive fork() and the
+    # batch queue only coalesces requests within one process. Tokenization and
+    # generate() already run off the event loop; uvloop/httptools are picked
+    # up automatically when installed (uvicorn[standard]).
     uvicorn.run(app, host="0.0.0.0", port=PORT)
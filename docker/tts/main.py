@@ -5,18 +5,21 @@ FastAPI wrapper for Qwen3-TTS real model inference using qwen-tts package
 """
 
 import os
-import io
-import base64
-import tempfile
+import struct
 from typing import Optional, Literal
 from contextlib import asynccontextmanager
 from pydantic import BaseModel, Field
 
 import torch
 import numpy as np
-from scipy.io import wavfile
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+# SIMD-accelerated base64 when available
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
 
 # Import Qwen3-TTS
 from qwen_tts import Qwen3TTSModel
@@ -27,11 +30,16 @@ DEVICE = os.getenv("DEVICE", "cpu")
 CACHE_DIR = os.getenv("CACHE_DIR", "/cache")
 REFERENCE_AUDIO = os.getenv("REFERENCE_AUDIO", "/model/reference.wav")
 REFERENCE_TEXT = os.getenv("REFERENCE_TEXT", "your power is sufficient i said")
+QUANT_MODE = os.getenv("QUANT_MODE", "none").lower()  # none, int8 (CPU only)
 
 # Global model
 model = None
 model_loaded = False
 
+# Encoded REFERENCE_AUDIO prompt, rebuilt when the file's mtime changes
+voice_clone_prompt = None
+voice_clone_prompt_mtime = None
+
 
 class TTSRequest(BaseModel):
     """TTS request body."""
@@ -41,10 +49,43 @@ class TTSRequest(BaseModel):
     response_format: Literal["wav"] = Field("wav", description="Output audio format")
 
 
+def quantize_int8(tts_model):
+    """Return tts_model with its Linear layers dynamically quantized to int8.
+
+    Uses PyTorch's fbgemm kernels, which take the VNNI int8 dot-product path
+    on CPUs that support it. Quantizes a copy, so tts_model is left untouched
+    if this raises.
+    """
+    inner = getattr(tts_model, "model", None)
+    module = inner if isinstance(inner, torch.nn.Module) else tts_model
+    if not isinstance(module, torch.nn.Module):
+        raise TypeError(f"{type(tts_model).__name__} is not a torch module")
+
+    quantized = torch.ao.quantization.quantize_dynamic(
+        module, {torch.nn.Linear}, dtype=torch.qint8, inplace=False
+    )
+    if module is tts_model:
+        return quantized
+    tts_model.model = quantized
+    return tts_model
+
+
+def has_weight_files(path: str) -> bool:
+    """Check whether a directory contains model weights, stopping at the first match."""
+    try:
+        with os.scandir(path) as entries:
+            return any(
+                entry.name.endswith(('.bin', '.safetensors', '.pt', '.pth'))
+                for entry in entries
+            )
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Load model on startup and cleanup on shutdown."""
-    global model_loaded, model
+    global model_loaded, model, voice_clone_prompt
 
     print(f"Loading TTS service...")
     print(f"Model path: {MODEL_PATH}")
@@ -52,10 +93,7 @@ async def lifespan(app: FastAPI):
     print(f"Reference audio: {REFERENCE_AUDIO}")
 
     # Check if model files exist
-    model_files_exist = os.path.exists(MODEL_PATH) and any(
-        f.endswith(('.bin', '.safetensors', '.pt', '.pth'))
-        for f in os.listdir(MODEL_PATH)
-    ) if os.path.exists(MODEL_PATH) else False
+    model_files_exist = has_weight_files(MODEL_PATH)
 
     if model_files_exist:
         try:
@@ -70,6 +108,20 @@ async def lifespan(app: FastAPI):
             traceback.print_exc()
             print("Service will run in fallback mode")
             model_loaded = False
+
+        if model_loaded and QUANT_MODE == "int8" and DEVICE == "cpu":
+            try:
+                model = quantize_int8(model)
+                print("✓ Linear layers quantized to int8")
+            except Exception as e:
+                print(f"✗ int8 quantization failed, keeping unquantized model: {e}")
+
+        if model_loaded:
+            try:
+                if "voice_clone_prompt" in voice_clone_kwargs():
+                    print(f"✓ Reference voice encoded: {REFERENCE_AUDIO}")
+            except Exception as e:
+                print(f"✗ Error encoding reference audio: {e}")
     else:
         print(f"✗ Model files not found at {MODEL_PATH}")
         print("Service will run in fallback mode")
@@ -81,6 +133,7 @@ async def lifespan(app: FastAPI):
     print("Shutting down TTS service...")
     model_loaded = False
     model = None
+    voice_clone_prompt = None
 
 
 app = FastAPI(
@@ -91,6 +144,18 @@ app = FastAPI(
 )
 
 
+def to_int16(audio: np.ndarray) -> np.ndarray:
+    """Convert float audio in [-1, 1] to int16, saturating instead of wrapping on clipping."""
+    audio = np.asarray(audio)
+    if not np.issubdtype(audio.dtype, np.floating):
+        return audio.astype(np.int16, copy=False)
+
+    scaled = np.multiply(audio, 32767.0, dtype=np.float32)
+    np.rint(scaled, out=scaled)
+    np.clip(scaled, -32768, 32767, out=scaled)
+    return scaled.astype(np.int16)
+
+
 def generate_fallback_audio(text: str, speed: float = 1.0, sample_rate: int = 24000):
     """Generate fallback audio (sine wave) when model is not available."""
     has_chinese = any('\u4e00' <= c <= '\u9fff' for c in text)
@@ -99,17 +164,62 @@ def generate_fallback_audio(text: str, speed: float = 1.0, sample_rate: int = 24
 
     t = np.linspace(0, duration, int(sample_rate * duration), False)
     freq = 440
-    audio = (0.3 * np.sin(2 * np.pi * freq * t) +
-             0.15 * np.sin(2 * np.pi * freq * 2 * t) +
-             0.1 * np.sin(2 * np.pi * freq * 3 * t))
+    # Fundamental plus two harmonics in a single sin() pass
+    freqs = np.array([freq, 2 * freq, 3 * freq]) * (2 * np.pi)
+    weights = np.array([0.3, 0.15, 0.1])
+    audio = weights @ np.sin(np.outer(freqs, t))
 
-    envelope = np.ones_like(audio)
+    # Fade in/out only touches the edges, no full-length envelope needed
     fade_samples = min(int(0.01 * sample_rate), len(audio) // 4)
-    envelope[:fade_samples] = np.linspace(0, 1, fade_samples)
-    envelope[-fade_samples:] = np.linspace(1, 0, fade_samples)
-    audio = audio * envelope
+    audio[:fade_samples] *= np.linspace(0, 1, fade_samples)
+    audio[-fade_samples:] *= np.linspace(1, 0, fade_samples)
+
+    return to_int16(audio), sample_rate, duration
+
+
+def voice_clone_kwargs() -> dict:
+    """Reference-voice kwargs for generate_voice_clone, reusing the encoded reference."""
+    global voice_clone_prompt, voice_clone_prompt_mtime
+
+    try:
+        mtime = os.stat(REFERENCE_AUDIO).st_mtime
+    except OSError:
+        return {"ref_audio": None, "ref_text": None}
 
-    return (audio * 32767).astype(np.int16), sample_rate, duration
+    if not hasattr(model, "create_voice_clone_prompt"):
+        return {"ref_audio": REFERENCE_AUDIO, "ref_text": REFERENCE_TEXT}
+
+    if voice_clone_prompt is None or mtime != voice_clone_prompt_mtime:
+        voice_clone_prompt = model.create_voice_clone_prompt(
+            ref_audio=REFERENCE_AUDIO,
+            ref_text=REFERENCE_TEXT
+        )
+        voice_clone_prompt_mtime = mtime
+
+    return {"voice_clone_prompt": voice_clone_prompt}
+
+
+def b64encode_str(data: bytes) -> str:
+    """Base64-encode bytes straight to str, without an intermediate bytes copy if possible."""
+    if hasattr(base64, "b64encode_as_string"):
+        return base64.b64encode_as_string(memoryview(data))
+    return base64.b64encode(data).decode("ascii")
+
+
+def wav_bytes(samples: np.ndarray, sample_rate: int) -> bytes:
+    """Encode mono PCM samples (int16 or float32) as an in-memory WAV file."""
+    data = samples.tobytes()
+    format_tag = 3 if samples.dtype.kind == "f" else 1  # IEEE float / PCM
+    sample_width = samples.dtype.itemsize
+
+    header = struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 36 + len(data), b"WAVE",
+        b"fmt ", 16, format_tag, 1, sample_rate,
+        sample_rate * sample_width, sample_width, sample_width * 8,
+        b"data", len(data),
+    )
+    return header + data
 
 
 @app.get("/health")
@@ -142,43 +252,37 @@ async def root():
 
 
 @app.post("/v1/tts")
-async def text_to_speech(request: TTSRequest):
+async def text_to_speech(request: TTSRequest, raw: bool = False):
     """
     Convert text to speech using Qwen3-TTS model.
+
+    Returns JSON with base64-encoded WAV audio. With ``?raw=true`` the WAV
+    bytes are streamed back directly as ``audio/wav``.
     """
     try:
         if model is not None and model_loaded:
             # Use real Qwen3-TTS model
             print(f"Generating speech for: {request.text[:50]}...")
             
-            # Check if reference audio exists
-            ref_audio = REFERENCE_AUDIO if os.path.exists(REFERENCE_AUDIO) else None
-            ref_text = REFERENCE_TEXT if ref_audio else None
-            
             # Generate speech with voice cloning
             audios, sample_rate = model.generate_voice_clone(
                 text=request.text,
-                ref_audio=ref_audio,
-                ref_text=ref_text,
-                language='auto'
+                language='auto',
+                **voice_clone_kwargs()
             )
             
-            # Convert to int16
-            if isinstance(audios[0], np.floating):
-                audio_int16 = (audios[0] * 32767).astype(np.int16)
-            else:
-                audio_int16 = audios[0]
-            
-            # Save to buffer
-            buffer = io.BytesIO()
-            wavfile.write(buffer, sample_rate, audio_int16)
-            buffer.seek(0)
+            audio_int16 = to_int16(audios[0])
             
-            audio_base64 = base64.b64encode(buffer.read()).decode("utf-8")
+            wav = wav_bytes(audio_int16, sample_rate)
             duration = len(audio_int16) / sample_rate
             
             print(f"✓ Generated {duration:.2f}s of audio")
             
+            if raw:
+                return StreamingResponse(iter([wav]), media_type="audio/wav")
+            
+            audio_base64 = b64encode_str(wav)
+            
             return {
                 "text": request.text,
                 "audio_base64": audio_base64,
@@ -193,11 +297,12 @@ async def text_to_speech(request: TTSRequest):
                 request.text, request.speed
             )
             
-            buffer = io.BytesIO()
-            wavfile.write(buffer, sample_rate, audio_array)
-            buffer.seek(0)
+            wav = wav_bytes(audio_array, sample_rate)
             
-            audio_base64 = base64.b64encode(buffer.read()).decode("utf-8")
+            if raw:
+                return StreamingResponse(iter([wav]), media_type="audio/wav")
+            
+            audio_base64 = b64encode_str(wav)
             
             return {
                 "text": request.text,
@@ -233,31 +338,18 @@ async def openai_compatible_tts(request: OpenAITTSRequest):
 
     try:
         # Use real Qwen3-TTS model
-        ref_audio = REFERENCE_AUDIO if os.path.exists(REFERENCE_AUDIO) else None
-        ref_text = REFERENCE_TEXT if ref_audio else None
-        
         audios, sample_rate = model.generate_voice_clone(
             text=request.input,
-            ref_audio=ref_audio,
-            ref_text=ref_text,
-            language='auto'
+            language='auto',
+            **voice_clone_kwargs()
         )
         
-        # Convert to int16
-        if isinstance(audios[0], np.floating):
-            audio_int16 = (audios[0] * 32767).astype(np.int16)
-        else:
-            audio_int16 = audios[0]
-        
-        # Save to temporary file
-        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as tmp:
-            tmp_path = tmp.name
-            wavfile.write(tmp_path, sample_rate, audio_int16)
+        audio_int16 = to_int16(audios[0])
         
-        return FileResponse(
-            tmp_path,
+        return Response(
+            content=wav_bytes(audio_int16, sample_rate),
             media_type="audio/wav",
-            filename="speech.wav"
+            headers={"Content-Disposition": 'attachment; filename="speech.wav"'}
         )
 
     except Exception as e:
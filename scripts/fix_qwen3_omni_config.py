@@ -6,15 +6,46 @@ The issue: 'Qwen3OmniMoeTalkerCodePredictorConfig' object has no attribute 'use_
 
 import json
 import os
+import shutil
+import tempfile
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 model_path = "/mnt/data/models/.cache/models--Qwen--Qwen3-Omni-30B-A3B-Instruct"
 config_path = os.path.join(model_path, "config.json")
 
+def load_json(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def dump_json(obj):
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=2).encode()
+
+def write_atomic(path, data):
+    """Write to a temp file next to path, then os.replace() it into place"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
 def fix_config():
     print(f"Reading config from: {config_path}")
     
-    with open(config_path, 'r') as f:
-        config = json.load(f)
+    config = load_json(config_path)
     
     # Check if talker_config exists and fix the code_predictor_config
     if 'talker_config' in config:
@@ -35,16 +66,15 @@ def fix_config():
                 print("Adding sliding_window = 72")
                 code_pred_config['sliding_window'] = 72
     
-    # Backup original config
+    # Backup original config (copy, so config.json is never missing)
     backup_path = config_path + '.backup'
     if not os.path.exists(backup_path):
         print(f"Creating backup: {backup_path}")
-        os.rename(config_path, backup_path)
+        shutil.copy2(config_path, backup_path)
     
     # Write fixed config
     print(f"Writing fixed config to: {config_path}")
-    with open(config_path, 'w') as f:
-        json.dump(config, f, indent=2)
+    write_atomic(config_path, dump_json(config))
     
     print("✓ Config fixed!")
 
@@ -3,6 +3,13 @@
 Test Qwen3-Omni-30B model loading with Transformers
 """
 
+import importlib.util
+import os
+
+# Use hf_transfer's parallel downloads for the first pull of the model
+if importlib.util.find_spec("hf_transfer") is not None:
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+
 import torch
 from transformers import Qwen3OmniMoeForConditionalGeneration, AutoProcessor
 from PIL import Image
@@ -43,7 +50,7 @@ try:
     inputs = processor(text=[text_input], return_tensors="pt").to(model.device)
     
     print("Generating response...")
-    with torch.no_grad():
+    with torch.inference_mode():
         outputs = model.generate(**inputs, max_new_tokens=100)
     
     response = processor.batch_decode(outputs, skip_special_tokens=True)[0]